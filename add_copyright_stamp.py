@@ -1,89 +1,495 @@
 import os
+import json
+import shutil
+import struct
 import subprocess
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIGURATION ---
 SEARCH_DIR = "."  # Current directory (or change to your path)
 MAX_PARALLEL_TASKS = 4
 
+# Cores this process may actually run on. In a cpuset-limited container this is
+# smaller than os.cpu_count(), which reports every core of the host.
+USABLE_CORES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 4)
+
+# How many threads each FFmpeg may use (override with FFMPEG_THREADS_PER_PROC)
+THREADS_PER_PROC = int(os.environ.get("FFMPEG_THREADS_PER_PROC", 0)) or \
+    max(1, USABLE_CORES // MAX_PARALLEL_TASKS)
+
+# Stamping is a stream copy (no encoding), so it is limited by the NAS, not
+# the CPU. This pool can be wider than MAX_PARALLEL_TASKS.
+IO_PARALLEL_TASKS = 8
+
 # --- COPYRIGHT INFO ---
 COPYRIGHT_HOLDER = "Copyright © Shechen Archives. All Rights Reserved."
 PROJECT_NAME = "Khyentse Önang"
 DESCRIPTION = "Preserved by the Khyentse Önang Project. Original media from Shechen Archives."
 
+# The FFmpeg remux is written to this local folder, then copied back once.
+# This saves one full write of every file over the network.
+SCRATCH_DIR = tempfile.gettempdir()
 
-def needs_stamping(filepath):
-    """Checks if the file already has the correct copyright tag."""
-    cmd = [
-        "ffprobe", "-v", "quiet",
-        "-show_entries", "format_tags=copyright",
-        "-of", "default=noprint_wrappers=1:nokey=1",
-        filepath
-    ]
+# Files that need a full remux are done several per FFmpeg process (one input
+# and one output each), so FFmpeg's startup cost is paid once per batch.
+# Every remuxed file sits in SCRATCH_DIR until it is copied back, so the peak
+# scratch use is STAMP_BATCH_SIZE x MAX_PARALLEL_REMUX_BATCHES full-size files
+# (8 x 2 = 16 here). Lower these if SCRATCH_DIR is small (e.g. a tmpfs /tmp).
+STAMP_BATCH_SIZE = 8
+MAX_PARALLEL_REMUX_BATCHES = 2
+
+# Only files inside these folders (at any depth) are stamped
+TARGET_DIRS = {"Masters", "Proxies"}
+
+# NAS system, trash and snapshot folders: never walked at all
+SKIP_DIRS = {"@eaDir", "#recycle", "#snapshot", "@Recycle", "@Recently-Snapshot", "lost+found"}
+
+# Don't load a "moov" atom bigger than this into memory (use ffprobe instead)
+MAX_MOOV_SIZE = 64 * 1024 * 1024
+
+# Tags written by the in-place fast path: the same ones FFmpeg writes to MOV.
+# Language 0x55C4 is "und"; a Mac language code would make readers decode
+# the text as MacRoman instead of UTF-8.
+STAMP_ATOMS = [
+    (b"\xa9cpy", COPYRIGHT_HOLDER),
+    (b"\xa9ART", PROJECT_NAME),
+    (b"\xa9cmt", DESCRIPTION),
+]
+STAMP_LANGUAGE = 0x55C4
+
+# iTunes-style (MP4) items that would shadow our tags, removed when patching
+SHADOWING_ILST_ITEMS = {b"cprt", b"\xa9cpy", b"\xa9ART", b"\xa9cmt"}
+
+# 3GPP-style 'udta' atoms that FFmpeg also reads as "copyright", removed when patching
+SHADOWING_UDTA_ITEMS = {b"cprt"}
+
+
+def iter_atoms(data, start, end):
+    """Yields (type, atom_start, payload_start, atom_end) for every atom in data[start:end]."""
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        header_size = 8
+        if size == 1:  # 64-bit size follows the type
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header_size = 16
+        elif size == 0:  # Atom runs to the end of its parent
+            size = end - pos
+        if size < header_size or pos + size > end:
+            raise ValueError("Malformed atom")
+        yield kind, pos, pos + header_size, pos + size
+        pos += size
+
+
+def find_top_level_atom(f, wanted):
+    """Walks the top-level atoms of an open file (headers only) and returns
+    (offset, header_size, size) of the first `wanted` atom, or None."""
+    f.seek(0, os.SEEK_END)
+    file_size = f.tell()
+    pos = 0
+    while pos + 8 <= file_size:
+        f.seek(pos)
+        header = f.read(16)
+        size, kind = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if size == 1:
+            size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif size == 0:
+            size = file_size - pos
+        if size < header_size:
+            raise ValueError("Malformed atom")
+        if kind == wanted:
+            return pos, header_size, size
+        pos += size
+    return None
+
+
+def meta_children_start(data, start):
+    """'meta' is a full atom (4 bytes of version/flags) in MP4, but not always in MOV."""
+    return start if data[start + 4:start + 8] == b"hdlr" else start + 4
+
+
+def read_udta_copyright(data, start, end):
+    """
+    Finds the copyright string inside a 'udta' atom ("" if there is none).
+    FFmpeg keeps the last copyright tag it reads, so the last one found wins here too.
+    """
+    copyright_tag = ""
+    for kind, _, child_start, child_end in iter_atoms(data, start, end):
+        if kind == b"\xa9cpy":
+            # QuickTime text: 16-bit length, 16-bit language, then the text
+            length = struct.unpack(">H", data[child_start:child_start + 2])[0]
+            copyright_tag = data[child_start + 4:child_start + 4 + length].decode("utf-8", "replace")
+        elif kind == b"cprt":
+            # 3GPP style: version/flags, 16-bit language, null-terminated text
+            copyright_tag = data[child_start + 6:child_end].rstrip(b"\0").decode("utf-8", "replace")
+        elif kind == b"meta":
+            for meta_kind, _, ilst_start, ilst_end in iter_atoms(data, meta_children_start(data, child_start), child_end):
+                if meta_kind != b"ilst":
+                    continue
+                # iTunes style: ilst > cprt > data (type, locale, then the text)
+                for item_kind, _, item_start, item_end in iter_atoms(data, ilst_start, ilst_end):
+                    if item_kind not in (b"cprt", b"\xa9cpy"):
+                        continue
+                    for data_kind, _, value_start, value_end in iter_atoms(data, item_start, item_end):
+                        if data_kind == b"data":
+                            copyright_tag = data[value_start + 8:value_end].decode("utf-8", "replace")
+    return copyright_tag
+
+
+def read_copyright_atom(filepath):
+    """
+    Reads the copyright tag straight from the MOV/MP4 atoms, without ffprobe.
+    Returns "" if there is no tag, or None if the layout isn't understood.
+    """
+    try:
+        with open(filepath, "rb") as f:
+            moov = find_top_level_atom(f, b"moov")
+            if moov is None:
+                return None
+            offset, header_size, size = moov
+            if size > MAX_MOOV_SIZE:
+                return None
+            f.seek(offset)
+            data = f.read(size)
+
+        copyright_tag = ""
+        for kind, _, start, end in iter_atoms(data, header_size, len(data)):
+            if kind == b"meta":
+                return None  # Keyed (mdta) metadata: let ffprobe decide
+            if kind == b"udta":
+                copyright_tag = read_udta_copyright(data, start, end)
+        return copyright_tag
+    except (OSError, ValueError, struct.error):
+        return None
+
+
+def get_copyright(filepath):
+    """Returns the file's current copyright tag ("" if it has none)."""
+    copyright_tag = read_copyright_atom(filepath)
+    if copyright_tag is not None:
+        return copyright_tag
+
+    # Fallback: ask ffprobe (one call, all format tags as JSON)
+    cmd = ["ffprobe", "-v", "quiet", "-print_format", "json", "-show_format", filepath]
     try:
         result = subprocess.run(cmd, stdout=subprocess.PIPE, text=True)
-        existing_copyright = result.stdout.strip()
-        # If the tag is missing or different, we need to stamp it
-        return COPYRIGHT_HOLDER not in existing_copyright
+        tags = json.loads(result.stdout).get("format", {}).get("tags", {})
+        return tags.get("copyright", "")
     except:
+        return ""
+
+
+def make_atom(kind, payload):
+    """Builds an atom with a 32-bit size header."""
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+def build_ilst(data, start, end):
+    """Rebuilds an 'ilst' payload without the items our tags replace."""
+    items = []
+    for kind, atom_start, _, atom_end in iter_atoms(data, start, end):
+        if kind not in SHADOWING_ILST_ITEMS:
+            items.append(data[atom_start:atom_end])
+    return b"".join(items)
+
+
+def build_udta(data, start, end):
+    """Rebuilds a 'udta' payload with our tags first, keeping every other tag."""
+    children = [
+        make_atom(kind, struct.pack(">HH", len(text.encode("utf-8")), STAMP_LANGUAGE) + text.encode("utf-8"))
+        for kind, text in STAMP_ATOMS
+    ]
+    stamp_kinds = {kind for kind, text in STAMP_ATOMS} | SHADOWING_UDTA_ITEMS
+    last_end = start
+    for kind, atom_start, child_start, child_end in iter_atoms(data, start, end):
+        last_end = child_end
+        if kind in stamp_kinds:
+            continue
+        if kind == b"meta":
+            # Keep the meta atom but drop the iTunes items that would win over ours
+            meta_start = meta_children_start(data, child_start)
+            meta_children = [data[child_start:meta_start]]
+            for meta_kind, meta_atom_start, ilst_start, ilst_end in iter_atoms(data, meta_start, child_end):
+                if meta_kind == b"ilst":
+                    meta_children.append(make_atom(b"ilst", build_ilst(data, ilst_start, ilst_end)))
+                else:
+                    meta_children.append(data[meta_atom_start:ilst_end])
+            children.append(make_atom(b"meta", b"".join(meta_children)))
+        else:
+            children.append(data[atom_start:child_end])
+    children.append(data[last_end:end])  # e.g. the 32-bit terminator QuickTime puts at the end
+    return b"".join(children)
+
+
+def build_moov(data, header_size):
+    """Returns the 'moov' atom with our tags in its 'udta', or None if unsupported."""
+    children = []
+    found_udta = False
+    for kind, atom_start, start, end in iter_atoms(data, header_size, len(data)):
+        if kind == b"meta":
+            return None  # Keyed (mdta) metadata: leave it to FFmpeg
+        if kind == b"udta":
+            children.append(make_atom(b"udta", build_udta(data, start, end)))
+            found_udta = True
+        else:
+            children.append(data[atom_start:end])
+    if not found_udta:
+        children.append(make_atom(b"udta", build_udta(data, 0, 0)))
+    return make_atom(b"moov", b"".join(children))
+
+
+def patch_copyright_inplace(filepath):
+    """
+    Writes the tags straight into the file's 'moov' atom, without copying the media.
+    Only done when no other atom has to move (moov is the last atom, or there is
+    enough 'free' space after it), so the sample offsets stay valid.
+    Returns False if the layout isn't supported; the caller then uses FFmpeg.
+    """
+    try:
+        with open(filepath, "r+b") as f:
+            moov = find_top_level_atom(f, b"moov")
+            if moov is None:
+                return False
+            offset, header_size, size = moov
+            if header_size != 8 or size > MAX_MOOV_SIZE:
+                return False
+            f.seek(offset)
+            data = f.read(size)
+
+            new_moov = build_moov(data, header_size)
+            if new_moov is None:
+                return False
+
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            moov_end = offset + size
+
+            # Space we may use: the old moov plus a 'free' atom right after it
+            room = size
+            if moov_end + 8 <= file_size:
+                f.seek(moov_end)
+                next_size, next_kind = struct.unpack(">I4s", f.read(8))
+                if next_kind in (b"free", b"skip") and next_size >= 8:
+                    room += next_size
+            slack = room - len(new_moov)
+
+            if moov_end == file_size:
+                # moov is the last atom: it can simply grow or shrink
+                f.seek(offset)
+                f.write(new_moov)
+                f.truncate()
+            elif slack == 0 or slack >= 8:
+                # Fill what's left of the old space with a new 'free' atom
+                f.seek(offset)
+                f.write(new_moov)
+                if slack:
+                    f.write(struct.pack(">I4s", slack, b"free"))
+            else:
+                return False
+
+            f.flush()
+            os.fsync(f.fileno())
         return True
+    except (OSError, ValueError, struct.error):
+        return False
+
+
+def drop_from_page_cache(path):
+    """
+    Tells the kernel we won't read this file again, so multi-GB video files
+    don't push everything else out of memory. Linux only; does nothing elsewhere.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)  # Only pages already written to disk can be dropped
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
 
 
 def stamp_file(filepath):
-    """Creates a temporary copy with metadata, then replaces the original."""
-    if not needs_stamping(filepath):
+    """
+    Checks the tag and writes it in place when the layout allows it.
+    Returns True if the file still needs a full remux (see remux_batch).
+    """
+    # If the tag is missing or different, we need to stamp it
+    if COPYRIGHT_HOLDER in get_copyright(filepath):
         print(f"  [OK] Already Stamped: {os.path.basename(filepath)}")
-        return
+        return False
 
-    # Create a temp filename
-    directory, filename = os.path.split(filepath)
-    temp_path = os.path.join(directory, f"temp_{filename}")
+    # Fast path: edit the tags in place (no copy of the media data at all)
+    if patch_copyright_inplace(filepath):
+        print(f"  [DONE] Updated in place: {os.path.basename(filepath)}")
+        return False
 
-    cmd = [
-        "ffmpeg", "-n", "-i", filepath,
-        "-c", "copy",  # <--- CRITICAL: Copies video/audio without re-encoding (Instant)
-        "-map", "0",
-        "-map_metadata", "0",
-        # New Tags
-        "-metadata", f"copyright={COPYRIGHT_HOLDER}",
-        "-metadata", f"artist={PROJECT_NAME}",
-        "-metadata", f"comment={DESCRIPTION}",
-        temp_path
-    ]
+    return True
 
-    print(f"  > Stamping: {filename}")
+
+def replace_with_copy(scratch_path, filepath):
+    """Copies a remuxed file back next to the original, then swaps it in."""
+    directory, filename = os.path.split(filepath)
+    temp_path = os.path.join(directory, f"temp_{filename}")
     try:
-        # Run FFmpeg (silently)
-        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        # Overwrites any leftover temp file from an interrupted run
+        shutil.copyfile(scratch_path, temp_path)
 
-        # If successful, replace the original file
+        # Neither copy will be read again, so drop both from the page cache first
+        drop_from_page_cache(filepath)
+        drop_from_page_cache(temp_path)
         os.replace(temp_path, filepath)
         print(f"  [DONE] Updated: {filename}")
-    except subprocess.CalledProcessError:
+    except OSError:
         print(f"  [ERROR] Failed to stamp: {filename}")
         if os.path.exists(temp_path):
             os.remove(temp_path)
 
 
+def remux_batch(filepaths):
+    """
+    Creates temporary copies with metadata for several files in ONE FFmpeg
+    process, then replaces the originals.
+    FFmpeg writes to local scratch; the NAS only receives the finished copies.
+    If the batch fails, each file is retried on its own so one bad file
+    doesn't hold back the others.
+    """
+    scratch_dir = tempfile.mkdtemp(prefix="ko_stamp_", dir=SCRATCH_DIR)
+    scratch_paths = [os.path.join(scratch_dir, f"{i:03d}_{os.path.basename(filepath)}")
+                     for i, filepath in enumerate(filepaths)]
+
+    cmd = ["ffmpeg", "-n"]
+    for filepath in filepaths:
+        cmd += ["-threads", str(THREADS_PER_PROC), "-i", filepath]
+    for i, scratch_path in enumerate(scratch_paths):
+        cmd += [
+            "-c", "copy",  # <--- CRITICAL: Copies video/audio without re-encoding (Instant)
+            "-map", str(i),
+            "-map_metadata", str(i),
+            "-map_chapters", str(i),  # Otherwise every output gets the first input's chapters
+            # New Tags
+            "-metadata", f"copyright={COPYRIGHT_HOLDER}",
+            "-metadata", f"artist={PROJECT_NAME}",
+            "-metadata", f"comment={DESCRIPTION}",
+            scratch_path
+        ]
+
+    for filepath in filepaths:
+        print(f"  > Stamping: {os.path.basename(filepath)}")
+    try:
+        # Run FFmpeg (silently)
+        result = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode != 0:
+            if len(filepaths) > 1:
+                print(f"  [RETRY] Batch failed, stamping its {len(filepaths)} files one at a time")
+                shutil.rmtree(scratch_dir, ignore_errors=True)  # Free the space before retrying
+                for filepath in filepaths:
+                    remux_batch([filepath])
+            else:
+                print(f"  [ERROR] Failed to stamp: {os.path.basename(filepaths[0])}")
+            return
+
+        # If successful, replace the original files
+        for scratch_path, filepath in zip(scratch_paths, filepaths):
+            replace_with_copy(scratch_path, filepath)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def make_batches(filepaths):
+    """Groups files by folder, in batches of at most STAMP_BATCH_SIZE."""
+    by_folder = {}
+    for filepath in sorted(filepaths):
+        by_folder.setdefault(os.path.dirname(filepath), []).append(filepath)
+
+    batches = []
+    for folder_files in by_folder.values():
+        for i in range(0, len(folder_files), STAMP_BATCH_SIZE):
+            batches.append(folder_files[i:i + STAMP_BATCH_SIZE])
+    return batches
+
+
+def find_candidate_folders(folder, inside_target):
+    """
+    Yields (folder, file names) for every folder under a Masters/Proxies folder.
+    Uses os.scandir directly so folder checks need no extra stat call, and
+    skips hidden and NAS system folders instead of descending into them.
+    """
+    try:
+        with os.scandir(folder) as it:
+            entries = list(it)
+    except OSError:
+        return
+
+    files = []
+    subfolders = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name in SKIP_DIRS or entry.name.startswith("."):
+                continue
+            subfolders.append(entry)
+        elif inside_target:
+            files.append(entry.name)
+
+    if inside_target:
+        yield folder, files
+    for entry in subfolders:
+        yield from find_candidate_folders(entry.path, inside_target or entry.name in TARGET_DIRS)
+
+
 def main():
     print(f"Scanning for Masters and Proxies in '{SEARCH_DIR}'...")
 
     files_to_process = []
 
-    # 1. Find all relevant files
-    for root, dirs, files in os.walk(SEARCH_DIR):
-        # Only look inside "Masters" and "Proxies" folders
-        if "Masters" in root or "Proxies" in root:
-            for file in files:
-                if file.lower().endswith(('.mov', '.mp4')):
-                    files_to_process.append(os.path.join(root, file))
+    # 1. Find all relevant files (only inside "Masters" and "Proxies" folders)
+    search_parts = os.path.abspath(SEARCH_DIR).split(os.sep)
+    starts_inside = any(part in TARGET_DIRS for part in search_parts)
+    for root, files in find_candidate_folders(SEARCH_DIR, starts_inside):
+        # Use the listing we already have instead of stat'ing files again
+        names = set(files)
+        for file in files:
+            if file.startswith("temp_") and file[len("temp_"):] in names:
+                continue  # Leftover copy from an interrupted run, not a real file
+            if file.lower().endswith(('.mov', '.mp4')):
+                files_to_process.append(os.path.join(root, file))
 
     print(f"Found {len(files_to_process)} candidate files.")
-    print(f"Starting rapid metadata update with {MAX_PARALLEL_TASKS} workers...")
+    print(f"Starting rapid metadata update with {IO_PARALLEL_TASKS} workers...")
+
+    # 2. Process in parallel (stream copies only, so this is NAS-bound work)
+    with ThreadPoolExecutor(max_workers=IO_PARALLEL_TASKS) as io_pool:
+        # 2a. Check every file, and patch the tags in place where possible
+        needs_remux = []
+        futures = {io_pool.submit(stamp_file, path): path for path in files_to_process}
+
+        # Collect results so exceptions in a worker are reported, not swallowed
+        for future in as_completed(futures):
+            try:
+                if future.result():
+                    needs_remux.append(futures[future])
+            except Exception as e:
+                print(f"  [ERROR] Worker crashed on {os.path.basename(futures[future])}: {str(e)}")
 
-    # 2. Process in parallel
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TASKS) as executor:
-        executor.map(stamp_file, files_to_process)
+    # 2b. Remux the rest, several files per FFmpeg process. Own, smaller pool:
+    # each running batch holds a whole batch of full copies in scratch.
+    batches = make_batches(needs_remux)
+    if batches:
+        print(f"Remuxing {len(needs_remux)} files in {len(batches)} FFmpeg batches...")
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_REMUX_BATCHES) as remux_pool:
+        futures = {remux_pool.submit(remux_batch, batch): batch for batch in batches}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                names = ", ".join(os.path.basename(path) for path in futures[future])
+                print(f"  [ERROR] Worker crashed on {names}: {str(e)}")
 
     print("\nAll files updated.")
 
@@ -1,8 +1,13 @@
 import pandas as pd
 import os
+import queue
+import shutil
 import subprocess
+import tempfile
 import threading
-from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # --- CONFIGURATION ---------------------------------------------------------
 # Mode 1 = Masters only (ProRes)
@@ -14,18 +19,92 @@ PROCESSING_MODE = 2
 # Start with 4. If CPU is still low, try 8. If NAS slows down, go back to 2.
 MAX_PARALLEL_TASKS = 4
 
+# Cores this process may actually run on. In a cpuset-limited container this is
+# smaller than os.cpu_count(), which reports every core of the host.
+USABLE_CORES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 4)
+
+# How many threads each FFmpeg may use. By default the cores are shared out
+# between the parallel tasks so they don't fight each other for the CPU.
+# Set the FFMPEG_THREADS_PER_PROC environment variable to override.
+THREADS_PER_PROC = int(os.environ.get("FFMPEG_THREADS_PER_PROC", 0)) or \
+    max(1, USABLE_CORES // MAX_PARALLEL_TASKS)
+
+# Encodes are CPU-bound and run MAX_PARALLEL_TASKS at a time.
+# Pure "copy" jobs (ProRes masters) only wait on the NAS and get their own pool.
+IO_PARALLEL_TASKS = 8
+
+# Pin each encode to its own group of cores (Linux, needs "taskset"), so the
+# parallel encoders don't keep evicting each other from the CPU caches.
+PIN_ENCODERS_TO_CORES = True
+
+# libx264 preset for proxies. "medium" is about twice as fast as "slow"
+# for files only a few percent bigger.
+PROXY_PRESET = "medium"
+
+# Use a GPU H.264 encoder (NVENC / VideoToolbox) for proxies when one works.
+# Falls back to libx264 automatically if none is found, and for any single
+# GPU encode that fails (e.g. the driver's limit on parallel NVENC sessions).
+USE_HARDWARE_ENCODER = True
+
+# libx264 proxy video codec flags
+SOFTWARE_CODEC_ARGS = ["-c:v", "libx264", "-crf", "23", "-preset", PROXY_PRESET]
+
+# Proxy video codec flags. main() replaces this with detect_proxy_codec_args().
+PROXY_CODEC_ARGS = SOFTWARE_CODEC_ARGS
+
+# Long files are cut into segments that are encoded in parallel, then joined
+# without re-encoding, so one long file doesn't keep a single worker busy
+# while the others sit idle. Only proxies are split.
+SEGMENT_MIN_SECONDS = 10 * 60  # Split files longer than this
+SEGMENT_SECONDS = 5 * 60  # Length of each segment
+
+# Proxies are written to this local folder first, then moved to the NAS.
+# The "+faststart" rewrite happens on local disk instead of over the network.
+# Up to MAX_PARALLEL_TASKS full proxies, plus the segments, audio and joined
+# proxy of up to IO_PARALLEL_TASKS long files, can sit here at once. On many
+# Linux systems /tmp is a tmpfs (RAM): point this at a local disk folder then.
+SCRATCH_DIR = tempfile.gettempdir()
+
 # --- CATALOG FILE -----------------------------------------------------------
 CATALOG_FILE = "Archive_Catalog_BRILLIANT Moon-MOV.csv"
 
+# Only these catalog columns are used; everything else is never loaded
+CATALOG_COLUMNS = ['Directory Path', 'Filename', 'Duration', 'Video Codec', 'Field Order', 'Audio Codec']
+
 # --- COPYRIGHT INFO ---------------------------------------------------------
 COPYRIGHT_HOLDER = "Copyright © Shechen Archives. All Rights Reserved."
 PROJECT_NAME = "Khyentse Önang"
 DESCRIPTION = "Preserved by the Khyentse Önang Project. Original media from Shechen Archives."
 
+# Tags we add to every single output
+METADATA_FLAGS = [
+    "-metadata", f"copyright={COPYRIGHT_HOLDER}",
+    "-metadata", f"artist={PROJECT_NAME}",
+    "-metadata", f"comment={DESCRIPTION}",
+]
+
+# Start of every FFmpeg command ("-threads" before "-i" covers decoding)
+FFMPEG_PREFIX = ["ffmpeg", "-hide_banner", "-loglevel", "error",
+                 "-threads", str(THREADS_PER_PROC), "-n"]
+
+# Placeholder for the output path in the command templates
+OUTPUT = "{OUTPUT}"
+
+# Output arguments for each kind of output, keyed by (kind, flag).
+# main() fills this once with build_command_templates().
+TEMPLATES = {}
+
+# Queue of free core groups (e.g. "0,1,2,3") for pinned encodes.
+# main() fills it from build_cpu_slots(); None means no pinning.
+cpu_slots = None
+
 # Lock to prevent messy printing when multiple threads write to the console/file at once
 print_lock = threading.Lock()
 log_file_path = "conversion_errors.log"
 
+# How many lines of FFmpeg's error output to keep for the log
+STDERR_TAIL_LINES = 40
+
 
 def log_error(message):
     """Writes error messages to a file so they aren't lost."""
@@ -35,170 +114,588 @@ def log_error(message):
             f.write(message + "\n")
 
 
-def run_ffmpeg_safe(command, output_file):
+def build_cpu_slots():
+    """
+    Splits the cores this process may use into MAX_PARALLEL_TASKS groups,
+    one per encode worker. Returns [] when pinning isn't possible.
+    """
+    if not PIN_ENCODERS_TO_CORES or not hasattr(os, "sched_getaffinity") or not shutil.which("taskset"):
+        return []
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < MAX_PARALLEL_TASKS:
+        return []
+    count = MAX_PARALLEL_TASKS
+    return [",".join(str(core) for core in cores[len(cores) * i // count:len(cores) * (i + 1) // count])
+            for i in range(count)]
+
+
+@contextmanager
+def cpu_slot():
+    """
+    Borrows a core group for one encode and yields the command prefix that pins
+    FFmpeg to it ([] when pinning is off). Only use this in the CPU pool: there
+    are exactly as many groups as CPU workers, so a slot is always free.
+    """
+    if cpu_slots is None:
+        yield []
+        return
+    slot = cpu_slots.get()
+    try:
+        yield ["taskset", "-c", slot]
+    finally:
+        cpu_slots.put(slot)
+
+
+def run_ffmpeg_pinned(command, output_files):
+    """run_ffmpeg_safe() for encode jobs running in the CPU pool."""
+    with cpu_slot() as pin_prefix:
+        return run_ffmpeg_safe(pin_prefix + command, output_files)
+
+
+def run_ffmpeg_safe(command, output_files):
     """
     Runs FFmpeg, checks for errors, and cleans up bad files.
+    One FFmpeg call can write several outputs, so `output_files` is a list.
     """
     try:
+        # Outputs that exist before the call (e.g. made by another catalog row
+        # with the same name) belong to someone else: never delete them
+        preexisting = {f for f in output_files if os.path.exists(f)}
+
         # Run FFmpeg and capture the error output (stderr)
-        result = subprocess.run(
+        process = subprocess.Popen(
             command,
             stdout=subprocess.DEVNULL,  # Hide standard output
             stderr=subprocess.PIPE,  # Capture errors
-            text=True  # Decode output as text
+            text=True,  # Decode output as text
+            errors="replace"
         )
 
+        # Only keep the last lines: a long encode can print megabytes to stderr
+        stderr_tail = deque(process.stderr, maxlen=STDERR_TAIL_LINES)
+        returncode = process.wait()
+
         # CHECK 1: Did FFmpeg report a failure? (Non-zero exit code)
-        if result.returncode != 0:
-            error_snippet = result.stderr[-600:]  # Get the last 600 characters of the error
-            log_error(f"\n❌ [CRASH] Failed to convert: {os.path.basename(output_file)}")
-            log_error(f"   Command Exit Code: {result.returncode}")
+        if returncode != 0:
+            error_snippet = "".join(stderr_tail)
+            names = ", ".join(os.path.basename(f) for f in output_files)
+            log_error(f"\n❌ [CRASH] Failed to convert: {names}")
+            log_error(f"   Command Exit Code: {returncode}")
             log_error(f"   FFmpeg Error Log:\n{error_snippet}\n" + "-" * 40)
 
-            # Cleanup: Delete the 0-byte or corrupted file
-            if os.path.exists(output_file):
-                os.remove(output_file)
-                log_error(f"   🗑️  Deleted broken file: {output_file}")
+            # Cleanup: Delete the 0-byte or corrupted files
+            for output_file in output_files:
+                if output_file in preexisting:
+                    log_error(f"   [SKIP] Already existed, left untouched: {output_file}")
+                elif os.path.exists(output_file):
+                    os.remove(output_file)
+                    log_error(f"   🗑️  Deleted broken file: {output_file}")
             return False
 
         # CHECK 2: Did it create a 0-byte file despite saying "Success"?
-        if os.path.exists(output_file):
-            if os.path.getsize(output_file) == 0:
-                log_error(f"\n⚠️ [EMPTY] FFmpeg finished but file is 0 bytes: {os.path.basename(output_file)}")
-                os.remove(output_file)
-                log_error(f"   🗑️  Deleted empty file.")
-                return False
-        else:
-            log_error(f"\n❓ [MISSING] FFmpeg finished but output file not found: {output_file}")
-            return False
+        all_ok = True
+        for output_file in output_files:
+            if os.path.exists(output_file):
+                if os.path.getsize(output_file) == 0 and output_file not in preexisting:
+                    log_error(f"\n⚠️ [EMPTY] FFmpeg finished but file is 0 bytes: {os.path.basename(output_file)}")
+                    os.remove(output_file)
+                    log_error(f"   🗑️  Deleted empty file.")
+                    all_ok = False
+            else:
+                log_error(f"\n❓ [MISSING] FFmpeg finished but output file not found: {output_file}")
+                all_ok = False
 
-        return True
+        return all_ok
 
     except Exception as e:
-        log_error(f"\n🔥 [EXCEPTION] Python script error on {output_file}: {str(e)}")
+        log_error(f"\n🔥 [EXCEPTION] Python script error on {output_files}: {str(e)}")
+        return False
+
+
+def build_command_templates():
+    """
+    Builds the output arguments for every kind of output once, at startup:
+      ('master', needs_transcode), ('proxy', is_interlaced), ('segment', is_interlaced)
+    Workers only have to put the output path in place of OUTPUT.
+    """
+    # Encoder threads (the "-threads" before "-i" only covers decoding)
+    thread_flags = ["-threads", str(THREADS_PER_PROC)]
+    # Our tags, plus the original metadata (like dates) from source
+    metadata_flags = METADATA_FLAGS + ["-map_metadata", "0"]
+
+    templates = {
+        # Copy Mode (already ProRes)
+        ('master', False): [
+            "-c", "copy",
+            "-map", "0"
+        ] + thread_flags + metadata_flags + [OUTPUT],
+        # Transcode Mode
+        ('master', True): [
+            "-c:v", "prores_ks", "-profile:v", "2", "-vendor", "apl0",
+            "-bits_per_mb", "8000", "-pix_fmt", "yuv422p10le",
+            "-c:a", "pcm_s16le", "-ar", "48000",
+            "-map", "0"
+        ] + thread_flags + metadata_flags + [OUTPUT],
+    }
+
+    for is_interlaced in (False, True):
+        vf_filters = ["yadif", "format=yuv420p"] if is_interlaced else ["format=yuv420p"]
+        templates[('proxy', is_interlaced)] = PROXY_CODEC_ARGS + [
+            "-vf", ",".join(vf_filters),
+            "-c:a", "aac", "-b:a", "192k", "-ar", "48000",
+            "-movflags", "+faststart",
+            "-max_muxing_queue_size", "1024",
+            # FIXED: Map ALL video and ALL audio, but exclude Data streams.
+            # "?" = a source without audio must not fail the whole command
+            "-map", "0:v", "-map", "0:a?"
+        ] + thread_flags + metadata_flags + [OUTPUT]
+        # Video-only piece of a long proxy (see encode_proxy_segmented)
+        templates[('segment', is_interlaced)] = PROXY_CODEC_ARGS + [
+            "-vf", ",".join(vf_filters),
+            "-an", "-map", "0:v"
+        ] + thread_flags + [OUTPUT]
+
+    return templates
+
+
+def fill_template(template, output_path):
+    """Returns a template's arguments with the real output path filled in."""
+    return [output_path if arg == OUTPUT else arg for arg in template]
+
+
+def detect_proxy_codec_args():
+    """
+    Picks the proxy video encoder once at startup.
+    A GPU encoder is only used if a tiny test encode with it succeeds, because
+    FFmpeg lists NVENC even on machines without an NVIDIA card.
+    """
+    if not USE_HARDWARE_ENCODER:
+        return SOFTWARE_CODEC_ARGS
+
+    hardware_candidates = [
+        ("h264_nvenc", ["-c:v", "h264_nvenc", "-preset", "p5", "-rc", "vbr", "-cq", "23", "-b:v", "0"]),
+        ("h264_videotoolbox", ["-c:v", "h264_videotoolbox", "-q:v", "65"]),
+    ]
+    try:
+        encoders = subprocess.check_output(
+            ["ffmpeg", "-hide_banner", "-encoders"], stderr=subprocess.DEVNULL, text=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return SOFTWARE_CODEC_ARGS
+
+    for name, codec_args in hardware_candidates:
+        if name not in encoders:
+            continue
+        test_cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-f", "lavfi", "-i", "color=black:s=256x256:d=0.2",
+            "-vf", "format=yuv420p"
+        ] + codec_args + ["-f", "null", "-"]
+        result = subprocess.run(test_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if result.returncode == 0:
+            return codec_args
+
+    return SOFTWARE_CODEC_ARGS
+
+
+def software_fallback_args(out_args):
+    """
+    Returns a proxy's output arguments with the GPU encoder swapped for libx264,
+    or None if they don't use the GPU encoder.
+    """
+    count = len(PROXY_CODEC_ARGS)
+    if PROXY_CODEC_ARGS == SOFTWARE_CODEC_ARGS or out_args[:count] != PROXY_CODEC_ARGS:
+        return None
+    return SOFTWARE_CODEC_ARGS + out_args[count:]
+
+
+def run_with_fallback(run, input_args, out_args, out_path):
+    """
+    Runs FFmpeg for one output. A failed GPU encode is retried once with
+    libx264, because the test encode at startup can't promise that every
+    later session will get the GPU.
+    """
+    if run(input_args + out_args, [out_path]):
+        return True
+    software_args = software_fallback_args(out_args)
+    if software_args is None:
         return False
+    log_error(f"   ↻ GPU encode failed, retrying with libx264: {os.path.basename(out_path)}")
+    return run(input_args + software_args, [out_path])
+
+
+def drop_from_page_cache(path):
+    """
+    Tells the kernel we won't read this file again, so multi-GB video files
+    don't push everything else out of memory. Linux only; does nothing elsewhere.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fdatasync(fd)  # Only pages already written to disk can be dropped
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+def move_into_place(src, dst):
+    """
+    Moves a finished file from local scratch to the NAS.
+    It is copied under a ".part" name first, so a half-copied file never looks finished.
+    Like "ffmpeg -n", it never overwrites an existing file (e.g. one made by
+    another catalog row with the same name): the scratch copy is discarded.
+    Returns True once the file is in place.
+    """
+    partial = dst + ".part"
+    try:
+        if os.path.exists(dst):
+            log_error(f"  [SKIP] Not overwriting existing file: {dst}")
+            return False
+        shutil.move(src, partial)
+        if os.path.exists(dst):  # Created while we were copying
+            os.remove(partial)
+            log_error(f"  [SKIP] Not overwriting existing file: {dst}")
+            return False
+        os.replace(partial, dst)
+        drop_from_page_cache(dst)
+        return True
+    except Exception:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+
+
+def list_dir_names(path):
+    """Returns the set of names in a folder (empty if the folder doesn't exist)."""
+    try:
+        with os.scandir(path) as entries:
+            return {entry.name for entry in entries}
+    except OSError:
+        return set()
 
 
-def process_single_file(row):
+def scan_output_folders(directory):
+    """Lists a source folder and its Masters/Proxies folders in one pass each."""
+    return (list_dir_names(directory),
+            list_dir_names(os.path.join(directory, "Masters")),
+            list_dir_names(os.path.join(directory, "Proxies")))
+
+
+def classify_codec(codec):
+    """Returns (needs_transcode, interlaced_hint) for a lower-cased codec name."""
+    return 'prores' not in codec, 'dvvideo' in codec or 'mpeg2video' in codec
+
+
+def is_interlaced_field_order(field_order):
+    """True for the field orders ffprobe reports for interlaced video."""
+    return 'interlaced' in field_order or 'bb' in field_order or 'tt' in field_order
+
+
+def needs_encoding(row):
+    """True if the row needs a real encode (CPU), False for a pure stream copy (NAS)."""
+    if (PROCESSING_MODE == 2 or PROCESSING_MODE == 3) and not row['_proxy_exists']:
+        return True  # Proxies are always encoded
+    return (PROCESSING_MODE == 1 or PROCESSING_MODE == 3) and row['needs_transcode']
+
+
+def needs_segmenting(row):
+    """True if the row's proxy is long enough to be encoded in parallel segments."""
+    return ((PROCESSING_MODE == 2 or PROCESSING_MODE == 3)
+            and row['_input_exists'] and not row['_proxy_exists']
+            and row['duration_s'] > SEGMENT_MIN_SECONDS)
+
+
+def process_single_file(row, skip_proxy=False):
     """
     This function handles the logic for ONE file.
     It will be run in parallel by the Executor.
+    `skip_proxy` is used when the proxy is made separately, in segments.
     """
     directory = row['Directory Path']
     filename = row['Filename']
-    input_path = os.path.join(directory, filename)
+    input_path = row['input_path']
 
-    if not os.path.exists(input_path):
+    if not row['_input_exists']:
         return f"SKIP: Missing file {filename}"
 
     # Create Output Folders (Thread-safe enough for this usage)
     if PROCESSING_MODE == 1 or PROCESSING_MODE == 3:
         masters_dir = os.path.join(directory, "Masters")
         os.makedirs(masters_dir, exist_ok=True)
-    if PROCESSING_MODE == 2 or PROCESSING_MODE == 3:
+    make_proxy = (PROCESSING_MODE == 2 or PROCESSING_MODE == 3) and not skip_proxy
+    if make_proxy:
         proxies_dir = os.path.join(directory, "Proxies")
         os.makedirs(proxies_dir, exist_ok=True)
 
     base_name = os.path.splitext(filename)[0]
 
-    # Logic setup
-    codec = str(row['Video Codec']).lower()
-    field_order = str(row['Field Order']).lower()
-
-    # --- METADATA FLAGS ---
-    # We add these to every single command
-    metadata_flags = [
-        "-metadata", f"copyright={COPYRIGHT_HOLDER}",
-        "-metadata", f"artist={PROJECT_NAME}",
-        "-metadata", f"comment={DESCRIPTION}",
-        # Also map original metadata (like dates) from source
-        "-map_metadata", "0"
-    ]
+    # Each entry is (label, output path, output args). All outputs share ONE
+    # FFmpeg call, so the source is read from the NAS and decoded only once.
+    outputs = []
+    scratch_dir = None
 
     if PROCESSING_MODE == 1 or PROCESSING_MODE == 3:
         # 1. MASTER ARCHIVE
         archive_out = os.path.join(masters_dir, f"{base_name}_Master.mov")
 
-        if not os.path.exists(archive_out):
-            # Build Archive Command
-            if 'prores' in codec:
-                # Copy Mode
-                cmd_archive = [
-                                  "ffmpeg", "-n", "-i", input_path,
-                                  "-c", "copy",
-                                  "-map", "0"
-                              ] + metadata_flags + [archive_out]  # Add metadata flags here
-            else:
-                # Transcode Mode
-                cmd_archive = [
-                                  "ffmpeg", "-n", "-i", input_path,
-                                  "-c:v", "prores_ks", "-profile:v", "2", "-vendor", "apl0",
-                                  "-bits_per_mb", "8000", "-pix_fmt", "yuv422p10le",
-                                  "-c:a", "pcm_s16le", "-ar", "48000",
-                                  "-map", "0"
-                              ] + metadata_flags + [archive_out]  # Add metadata flags here
-
-            # Run Archive
-            success = run_ffmpeg_safe(cmd_archive, archive_out)
-            if success:
-                print(f"  [DONE] Master: {filename}")
-            print(f"  [DONE] Master: {filename}")
+        if not row['_master_exists']:
+            template = TEMPLATES[('master', row['needs_transcode'])]
+            outputs.append(("Master:", archive_out, fill_template(template, archive_out)))
         else:
             print(f"  [SKIP] Master exists: {filename}")
 
-    if PROCESSING_MODE == 2 or PROCESSING_MODE == 3:
+    if make_proxy:
         # 2. PROXY SHARING
         sharing_out = os.path.join(proxies_dir, f"{base_name}_Share.mp4")
 
-        if not os.path.exists(sharing_out):
-            # Build Proxy Command
-            vf_filters = ["format=yuv420p"]
-            is_interlaced = False
-
-            if 'dvvideo' in codec or 'mpeg2video' in codec:
-                is_interlaced = True
-            elif 'interlaced' in field_order or 'bb' in field_order or 'tt' in field_order:
-                is_interlaced = True
-
-            if is_interlaced:
-                vf_filters.insert(0, "yadif")
-
-            cmd_sharing = [
-                              "ffmpeg", "-n", "-i", input_path,
-                              "-c:v", "libx264", "-crf", "23", "-preset", "slow",
-                              "-vf", ",".join(vf_filters),
-                              "-c:a", "aac", "-b:a", "192k", "-ar", "48000",
-                              "-movflags", "+faststart",
-                              # FIXED: Map ALL video and ALL audio, but exclude Data streams
-                              "-map", "0:v", "-map", "0:a"
-                          ] + metadata_flags + [sharing_out]  # Add metadata flags here
-
-            # Run Proxy
-            success = run_ffmpeg_safe(cmd_sharing, sharing_out)
-            if success:
-                print(f"  [DONE] Proxy:  {filename}")
+        if not row['_proxy_exists']:
+            # Encode to local scratch; it is moved to Proxies/ once it's done
+            scratch_dir = tempfile.mkdtemp(prefix="ko_proxy_", dir=SCRATCH_DIR)
+            scratch_out = os.path.join(scratch_dir, os.path.basename(sharing_out))
+            template = TEMPLATES[('proxy', row['is_interlaced'])]
+            outputs.append(("Proxy: ", scratch_out, fill_template(template, scratch_out)))
         else:
             print(f"  [SKIP] Proxy exists:  {filename}")
 
+    if outputs:
+        input_args = FFMPEG_PREFIX + ["-i", input_path]
+        cmd = list(input_args)
+        for label, out_path, out_args in outputs:
+            cmd += out_args
+
+        try:
+            # Run Master and/or Proxy
+            # Encodes run in the CPU pool and get pinned; stream copies don't
+            encodes_proxy = make_proxy and not row['_proxy_exists']
+            run = run_ffmpeg_pinned if encodes_proxy or row['needs_transcode'] else run_ffmpeg_safe
+            if len(outputs) == 1:
+                done = outputs if run_with_fallback(run, input_args, outputs[0][2], outputs[0][1]) else []
+            elif run(cmd, [out_path for label, out_path, out_args in outputs]):
+                done = outputs
+            else:
+                # One failing output aborts the shared call: give each its own
+                # call so a proxy problem can't cost the Master (and vice versa)
+                log_error(f"   ↻ Retrying Master and Proxy separately: {filename}")
+                done = [(label, out_path, out_args) for label, out_path, out_args in outputs
+                        if run_with_fallback(run, input_args, out_args, out_path)]
+
+            for label, out_path, out_args in done:
+                if scratch_dir and out_path == scratch_out:
+                    if not move_into_place(scratch_out, sharing_out):
+                        continue
+                else:
+                    drop_from_page_cache(out_path)
+                print(f"  [DONE] {label} {filename}")
+            if done:
+                drop_from_page_cache(input_path)
+        finally:
+            if scratch_dir:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+
     return f"COMPLETED: {filename}"
 
 
+def encode_proxy_segmented(row, cpu_pool, while_encoding=None):
+    """
+    Encodes a long proxy as SEGMENT_SECONDS pieces in parallel on the CPU pool,
+    then joins them without re-encoding.
+    Only the video is split: audio is encoded in one piece, because AAC
+    segments would click at every join.
+    `while_encoding` is called once all the pieces are queued, so other work
+    (e.g. the Master copy) overlaps with the encode instead of delaying it.
+    """
+    filename = row['Filename']
+    input_path = row['input_path']
+    base_name = os.path.splitext(filename)[0]
+
+    proxies_dir = os.path.join(row['Directory Path'], "Proxies")
+    os.makedirs(proxies_dir, exist_ok=True)
+    sharing_out = os.path.join(proxies_dir, f"{base_name}_Share.mp4")
+
+    segment_template = TEMPLATES[('segment', row['is_interlaced'])]
+
+    scratch_dir = tempfile.mkdtemp(prefix="ko_proxy_", dir=SCRATCH_DIR)
+    try:
+        # 1. Video segments. "-ss" before "-i" is frame-accurate when encoding,
+        # so the cuts don't need to be on keyframes.
+        segments = []
+        starts = list(range(0, int(row['duration_s']), SEGMENT_SECONDS))
+        for i, start in enumerate(starts):
+            segment_out = os.path.join(scratch_dir, f"segment_{i:04d}.mp4")
+            # The last segment runs to the end (the catalog duration is rounded)
+            length = ["-t", str(SEGMENT_SECONDS)] if i < len(starts) - 1 else []
+            input_args = FFMPEG_PREFIX + ["-ss", str(start)] + length + ["-i", input_path]
+            segments.append((input_args, segment_out))
+        segment_paths = [segment_out for input_args, segment_out in segments]
+        segment_jobs = [cpu_pool.submit(run_ffmpeg_pinned, input_args + fill_template(segment_template, segment_out),
+                                        [segment_out])
+                        for input_args, segment_out in segments]
+
+        # 2. The whole audio track, in one piece (silent sources have none)
+        audio_inputs = []
+        audio_job = None
+        if row['has_audio']:
+            audio_out = os.path.join(scratch_dir, "audio.m4a")
+            cmd = FFMPEG_PREFIX + ["-i", input_path,
+                                   "-vn", "-c:a", "aac", "-b:a", "192k", "-ar", "48000",
+                                   "-map", "0:a?", audio_out]
+            audio_job = cpu_pool.submit(run_ffmpeg_pinned, cmd, [audio_out])
+            audio_inputs = ["-i", audio_out]
+
+        if while_encoding:
+            try:
+                while_encoding()
+            except Exception as e:
+                log_error(f"\n🔥 [EXCEPTION] Worker crashed on {filename}: {str(e)}")
+
+        if not all([job.result() for job in segment_jobs]):
+            # A failed GPU segment is redone with libx264, but then ALL of them
+            # are: the join copies one set of encoder settings for the whole file
+            software_template = software_fallback_args(segment_template)
+            if software_template is None:
+                return False
+            log_error(f"   ↻ GPU encode failed, re-encoding all segments with libx264: {filename}")
+            for segment_out in segment_paths:
+                if os.path.exists(segment_out):
+                    os.remove(segment_out)
+            segment_jobs = [cpu_pool.submit(run_ffmpeg_pinned,
+                                            input_args + fill_template(software_template, segment_out),
+                                            [segment_out])
+                            for input_args, segment_out in segments]
+            if not all([job.result() for job in segment_jobs]):
+                return False
+
+        if audio_job and not audio_job.result():
+            return False
+
+        # 3. Join the segments, add the audio and the metadata (no re-encoding)
+        list_path = os.path.join(scratch_dir, "segments.txt")
+        with open(list_path, "w", encoding="utf-8") as f:
+            for segment_out in segment_paths:
+                f.write(f"file '{segment_out}'\n")
+
+        scratch_out = os.path.join(scratch_dir, os.path.basename(sharing_out))
+        audio_maps = ["-map", "1:a"] if audio_inputs else []
+        metadata_input = "2" if audio_inputs else "1"
+        cmd = FFMPEG_PREFIX + ["-f", "concat", "-safe", "0", "-i", list_path] + audio_inputs + [
+            "-i", input_path,  # Only read for its metadata
+            "-map", "0:v"
+        ] + audio_maps + [
+            "-c", "copy",
+            "-movflags", "+faststart"
+        ] + METADATA_FLAGS + ["-map_metadata", metadata_input, scratch_out]
+        if not run_ffmpeg_safe(cmd, [scratch_out]):
+            return False
+
+        if not move_into_place(scratch_out, sharing_out):
+            return False
+        drop_from_page_cache(input_path)
+        print(f"  [DONE] Proxy:  {filename} ({len(segment_paths)} segments)")
+        return True
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def process_long_file(row, cpu_pool):
+    """
+    Handles a file whose proxy is made in segments. This only waits on the
+    encodes it hands to `cpu_pool`, so it runs in the I/O pool.
+    """
+    master_job = None
+    copy_master = None
+    if PROCESSING_MODE == 3:
+        if row['needs_transcode']:
+            master_job = cpu_pool.submit(process_single_file, row, True)
+        else:
+            # Stream copy: NAS-bound, so it runs here while the segments encode
+            copy_master = lambda: process_single_file(row, skip_proxy=True)
+
+    encode_proxy_segmented(row, cpu_pool, while_encoding=copy_master)
+    if master_job:
+        master_job.result()
+
+    return f"COMPLETED: {row['Filename']}"
+
+
 def main():
+    global PROXY_CODEC_ARGS, TEMPLATES, cpu_slots
+
     try:
-        df = pd.read_csv(CATALOG_FILE)
+        # Plain strings only: no type guessing, and empty cells stay "" (not NaN)
+        df = pd.read_csv(CATALOG_FILE, usecols=CATALOG_COLUMNS, dtype=str, keep_default_na=False)
     except FileNotFoundError:
         print(f"Error: Could not find {CATALOG_FILE}")
         return
 
-    print(f"Found {len(df)} files. Starting Parallel Process with {MAX_PARALLEL_TASKS} workers...")
+    print(f"Found {len(df)} files. Starting Parallel Process with "
+          f"{MAX_PARALLEL_TASKS} encode / {IO_PARALLEL_TASKS} copy workers...")
     print("Output might be quiet while working. Please wait...")
 
-    # The Executor handles the parallel magic
-    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TASKS) as executor:
-        # Map the function to the rows
-        # We convert the dataframe to a list of dicts (rows) to iterate easily
-        rows = [row for index, row in df.iterrows()]
-        executor.map(process_single_file, rows)
+    if PROCESSING_MODE == 2 or PROCESSING_MODE == 3:
+        PROXY_CODEC_ARGS = detect_proxy_codec_args()
+        print(f"Proxy video encoder: {' '.join(PROXY_CODEC_ARGS)}")
+    TEMPLATES = build_command_templates()
+
+    slots = build_cpu_slots()
+    if slots:
+        cpu_slots = queue.Queue()
+        for slot in slots:
+            cpu_slots.put(slot)
+        print(f"Pinning encodes to core groups: {' | '.join(slots)}")
+
+    # Classify every row up front. A catalog has thousands of rows but only a
+    # handful of distinct codecs/field orders, so each one is checked once.
+    df['codec_l'] = df['Video Codec'].str.lower()
+    field_order = df['Field Order'].str.lower()
+    codec_table = {codec: classify_codec(codec) for codec in df['codec_l'].unique()}
+    field_table = {order: is_interlaced_field_order(order) for order in field_order.unique()}
+    df['needs_transcode'] = df['codec_l'].map({c: needs_tx for c, (needs_tx, _) in codec_table.items()})
+    df['is_interlaced'] = (df['codec_l'].map({c: hint for c, (_, hint) in codec_table.items()})
+                           | field_order.map(field_table))
+    df['input_path'] = df['Directory Path'] + os.sep + df['Filename']
+    df['has_audio'] = df['Audio Codec'].str.lower() != 'none'  # gen_video_catalog writes "none"
+    df['duration_s'] = pd.to_timedelta(df['Duration'], errors='coerce').dt.total_seconds().fillna(0)
+
+    # We convert the dataframe to a list of dicts (rows) to iterate easily
+    rows = df[['Directory Path', 'Filename', 'input_path',
+               'is_interlaced', 'needs_transcode', 'has_audio', 'duration_s']].to_dict('records')
+
+    # Preflight: list every folder once (in parallel) instead of one NAS stat
+    # per file and per output inside the workers
+    directories = sorted({row['Directory Path'] for row in rows})
+    with ThreadPoolExecutor(max_workers=IO_PARALLEL_TASKS) as io_pool:
+        listings = dict(zip(directories, io_pool.map(scan_output_folders, directories)))
+
+    for row in rows:
+        files, masters, proxies = listings[row['Directory Path']]
+        base_name = os.path.splitext(row['Filename'])[0]
+        row['_input_exists'] = row['Filename'] in files
+        row['_master_exists'] = f"{base_name}_Master.mov" in masters
+        row['_proxy_exists'] = f"{base_name}_Share.mp4" in proxies
+
+    # Two pools so copy jobs don't wait behind encodes (and vice versa)
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_TASKS) as cpu_pool, \
+            ThreadPoolExecutor(max_workers=IO_PARALLEL_TASKS) as io_pool:
+        futures = {}
+        for row in rows:
+            if needs_segmenting(row):
+                # Only waits on its segments (which go to cpu_pool), so it must
+                # not hold a cpu_pool slot itself
+                futures[io_pool.submit(process_long_file, row, cpu_pool)] = row['Filename']
+            else:
+                pool = cpu_pool if needs_encoding(row) else io_pool
+                futures[pool.submit(process_single_file, row)] = row['Filename']
+
+        # Collect results so exceptions in a worker are reported, not swallowed
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                log_error(f"\n🔥 [EXCEPTION] Worker crashed on {futures[future]}: {str(e)}")
 
     print("\nAll tasks complete.")
 
@@ -2,10 +2,14 @@ import os
 import sys
 import csv
 import json
-import subprocess
+import asyncio
 import math
 from datetime import datetime
 
+# How many ffprobe calls to run at once. Probing is waiting on the NAS,
+# not the CPU, so this can be higher than the number of cores.
+MAX_PARALLEL_PROBES = 16
+
 def format_size(size_bytes):
     """Converts bytes to human readable string (e.g., 1.2 GB)."""
     if not size_bytes or size_bytes == 0:
@@ -36,12 +40,12 @@ def clean_date_string(date_str):
         return ""
     return date_str.replace("T", " ").replace("Z", "").split(".")[0]
 
-def get_file_info(filepath):
+async def get_file_info(filepath):
     """Runs ffprobe and stat to get all metadata safely."""
     
-    # 1. Get File System Data
+    # 1. Get File System Data (in a thread: a NAS stat can block for a while)
     try:
-        stat_info = os.stat(filepath)
+        stat_info = await asyncio.to_thread(os.stat, filepath)
         file_size_bytes = stat_info.st_size
         readable_size = format_size(file_size_bytes)
         fs_modify_time = datetime.fromtimestamp(stat_info.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
@@ -53,8 +57,11 @@ def get_file_info(filepath):
     cmd = ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', filepath]
     
     try:
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        data = json.loads(result.stdout)
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL
+        )
+        stdout, _ = await process.communicate()
+        data = json.loads(stdout)
     except:
         return {
             'Filename': os.path.basename(filepath),
@@ -66,8 +73,8 @@ def get_file_info(filepath):
     # Extract Data
     fmt = data.get('format', {})
     tags = fmt.get('tags', {})
-    video = next((s for s in data.get('streams', []) if s['codec_type'] == 'video'), {})
-    audio = next((s for s in data.get('streams', []) if s['codec_type'] == 'audio'), {})
+    video = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), {})
+    audio = next((s for s in data.get('streams', []) if s.get('codec_type') == 'audio'), {})
 
     # Date Logic
     meta_date = tags.get('creation_time', '')
@@ -96,6 +103,26 @@ def get_file_info(filepath):
         'Channels': audio.get('channels', '')
     }
 
+async def probe_all(paths):
+    """Probes every path, with at most MAX_PARALLEL_PROBES ffprobe calls at once."""
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_PROBES)
+
+    async def bounded(filepath):
+        async with semaphore:
+            try:
+                info = await get_file_info(filepath)
+            except Exception as e:
+                # One odd file must not cost the whole catalog
+                print(f"Error: Could not catalog {filepath}: {e}")
+                return None
+        if info:
+            print(f"Cataloged: {info['Filename']}")
+        return info
+
+    # gather() keeps the results in the same order as `paths`
+    return await asyncio.gather(*[bounded(filepath) for filepath in paths])
+
+
 def main():
     dir = "Khyentsé Rinpoché-AVI"
     search_dir = f"/media/drupchen/Khyentse Önang/NAS/Video Archives/{dir}"
@@ -115,17 +142,20 @@ def main():
         writer = csv.DictWriter(csvfile, fieldnames=columns, extrasaction='ignore')
         writer.writeheader()
         
-        count = 0
+        # 1. Collect all the paths first
+        paths = []
         for root, dirs, files in os.walk(search_dir):
             for file in files:
                 if file.lower().endswith(('.avi', '.mov', '.mp4')):
-                    filepath = os.path.join(root, file)
-                    info = get_file_info(filepath)
-                    if info:
-                        writer.writerow(info)
-                        print(f"Cataloged: {file}")
-                        count += 1
-                        
+                    paths.append(os.path.join(root, file))
+
+        # 2. Probe concurrently, then write the rows in walk order
+        count = 0
+        for info in asyncio.run(probe_all(paths)):
+            if info:
+                writer.writerow(info)
+                count += 1
+
     print(f"\nDone! Processed {count} files.")
 
 if __name__ == "__main__":